@@ -4,8 +4,11 @@ import sqlite3
 import hashlib
 import datetime
 import json
+import re
 from functools import wraps
 import os
+import threading
+import time
 
 app = Flask(__name__)
 app.secret_key = 'montana-barber-shop-secret-key-2024'
@@ -14,6 +17,77 @@ CORS(app)
 # Configuración de la base de datos
 DATABASE = 'montana_barber.db'
 
+# Claves de idempotencia para la creación de citas
+IDEMPOTENCY_KEY_TTL_HOURS = 24
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = 3600
+
+# Búsqueda de clientes: filas del índice FTS consideradas antes de agrupar por cliente
+CUSTOMER_SEARCH_MAX_MATCHES = 500
+
+# Teléfono sin separadores, para que "555-123" y "555123" coincidan en el índice
+PHONE_DIGITS_SQL = "replace(replace(replace(replace(replace(replace({0}, ' ', ''), '-', ''), '(', ''), ')', ''), '+', ''), '.', '')"
+
+# Ajustes incrementales de la tabla customers al agregar o quitar una cita
+# ({row} = NEW u OLD, {phone} = su teléfono sin separadores, {phone_column} = lo mismo para appointments)
+CUSTOMER_ADD_SQL = '''
+    INSERT INTO customers (customer_phone, customer_name, total_appointments, completed_count, no_show_count, cancelled_count)
+    VALUES ({phone}, {row}.customer_name, 1,
+            {row}.status = 'completed', {row}.status = 'no-show', {row}.status = 'cancelled')
+    ON CONFLICT (customer_phone) DO UPDATE SET
+        total_appointments = total_appointments + 1,
+        completed_count = completed_count + excluded.completed_count,
+        no_show_count = no_show_count + excluded.no_show_count,
+        cancelled_count = cancelled_count + excluded.cancelled_count,
+        updated_at = CURRENT_TIMESTAMP;
+'''
+
+CUSTOMER_REMOVE_SQL = '''
+    UPDATE customers SET
+        total_appointments = total_appointments - 1,
+        completed_count = completed_count - ({row}.status = 'completed'),
+        no_show_count = no_show_count - ({row}.status = 'no-show'),
+        cancelled_count = cancelled_count - ({row}.status = 'cancelled'),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE customer_phone = {phone};
+    DELETE FROM customers WHERE customer_phone = {phone} AND total_appointments <= 0;
+'''
+
+# El nombre del cliente es siempre el de su cita más reciente
+CUSTOMER_REFRESH_SQL = '''
+    UPDATE customers SET
+        customer_name = (SELECT customer_name FROM appointments
+                         WHERE id = (SELECT MAX(id) FROM appointments WHERE {phone_column} = {phone})),
+        first_visit = (SELECT MIN(appointment_date) FROM appointments
+                       WHERE {phone_column} = {phone} AND status = 'completed'),
+        last_visit = (SELECT MAX(appointment_date) FROM appointments
+                      WHERE {phone_column} = {phone} AND status = 'completed')
+    WHERE customer_phone = {phone};
+'''
+
+FTS_ADD_SQL = '''
+    INSERT INTO appointments_fts (rowid, customer_name, customer_phone, notes)
+    VALUES ({0}.id, {0}.customer_name, ''' + PHONE_DIGITS_SQL.format('{0}.customer_phone') + ''', {0}.notes);
+'''
+
+FTS_REMOVE_SQL = '''
+    INSERT INTO appointments_fts (appointments_fts, rowid, customer_name, customer_phone, notes)
+    VALUES ('delete', {0}.id, {0}.customer_name, ''' + PHONE_DIGITS_SQL.format('{0}.customer_phone') + ''', {0}.notes);
+'''
+
+def customer_sync_sql(template, row):
+    """Completar una plantilla de sincronización de customers para NEW u OLD"""
+    return template.format(
+        row=row,
+        phone=PHONE_DIGITS_SQL.format(f'{row}.customer_phone'),
+        phone_column=PHONE_DIGITS_SQL.format('customer_phone')
+    )
+
+def normalize_phone(phone):
+    """Quitar los mismos separadores que PHONE_DIGITS_SQL"""
+    for separator in ' -()+.':
+        phone = phone.replace(separator, '')
+    return phone
+
 def get_db_connection():
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
@@ -96,6 +170,119 @@ def init_db():
         )
     ''')
     
+    # Tabla de claves de idempotencia (reintentos de POST /api/appointments)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            request_hash TEXT NOT NULL,
+            status_code INTEGER NOT NULL,
+            response_body TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys (expires_at)')
+    
+    conn.commit()
+    
+    # Índices de búsqueda de clientes. Se crean y rellenan en una sola transacción;
+    # si falta algún trigger de sincronización se reconstruyen desde las citas.
+    search_triggers = {'appointments_ai', 'appointments_ad', 'appointments_fts_au', 'customers_au'}
+    existing_triggers = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    phone_column = PHONE_DIGITS_SQL.format('customer_phone')
+    
+    conn.isolation_level = None
+    conn.execute('BEGIN')
+    try:
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_appointments_customer_phone ON appointments (' + phone_column + ', status, appointment_date)')
+        
+        # Índice de texto completo sobre nombre, teléfono y notas de las citas
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS appointments_fts USING fts5 (
+                customer_name, customer_phone, notes,
+                content = '',
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+        ''')
+        
+        # Tabla de clientes (por teléfono sin separadores) con estadísticas mantenidas por triggers
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS customers (
+                customer_phone TEXT PRIMARY KEY,
+                customer_name TEXT NOT NULL,
+                total_appointments INTEGER NOT NULL DEFAULT 0,
+                completed_count INTEGER NOT NULL DEFAULT 0,
+                no_show_count INTEGER NOT NULL DEFAULT 0,
+                cancelled_count INTEGER NOT NULL DEFAULT 0,
+                first_visit DATE,
+                last_visit DATE,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        if not search_triggers <= existing_triggers:
+            for trigger in search_triggers:
+                conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            
+            conn.execute("INSERT INTO appointments_fts (appointments_fts) VALUES ('delete-all')")
+            conn.execute('''
+                INSERT INTO appointments_fts (rowid, customer_name, customer_phone, notes)
+                SELECT id, customer_name, ''' + phone_column + ''', notes FROM appointments
+            ''')
+            
+            conn.execute('DELETE FROM customers')
+            conn.execute('''
+                INSERT INTO customers (customer_phone, customer_name, total_appointments, completed_count,
+                                       no_show_count, cancelled_count, first_visit, last_visit)
+                SELECT g.phone, latest.customer_name, g.total, g.completed, g.no_show, g.cancelled,
+                       g.first_visit, g.last_visit
+                FROM (
+                    SELECT ''' + phone_column + ''' AS phone,
+                           MAX(id) AS latest_id,
+                           COUNT(*) AS total,
+                           SUM(status = 'completed') AS completed,
+                           SUM(status = 'no-show') AS no_show,
+                           SUM(status = 'cancelled') AS cancelled,
+                           MIN(CASE WHEN status = 'completed' THEN appointment_date END) AS first_visit,
+                           MAX(CASE WHEN status = 'completed' THEN appointment_date END) AS last_visit
+                    FROM appointments
+                    GROUP BY phone
+                ) g
+                JOIN appointments latest ON latest.id = g.latest_id
+            ''')
+            
+            # Triggers que mantienen sincronizados el índice FTS y la tabla de clientes
+            conn.execute(
+                'CREATE TRIGGER appointments_ai AFTER INSERT ON appointments BEGIN '
+                + FTS_ADD_SQL.format('NEW')
+                + customer_sync_sql(CUSTOMER_ADD_SQL, 'NEW') + customer_sync_sql(CUSTOMER_REFRESH_SQL, 'NEW')
+                + ' END'
+            )
+            conn.execute(
+                'CREATE TRIGGER appointments_ad AFTER DELETE ON appointments BEGIN '
+                + FTS_REMOVE_SQL.format('OLD')
+                + customer_sync_sql(CUSTOMER_REMOVE_SQL, 'OLD') + customer_sync_sql(CUSTOMER_REFRESH_SQL, 'OLD')
+                + ' END'
+            )
+            conn.execute(
+                'CREATE TRIGGER appointments_fts_au AFTER UPDATE OF customer_name, customer_phone, notes ON appointments BEGIN '
+                + FTS_REMOVE_SQL.format('OLD') + FTS_ADD_SQL.format('NEW')
+                + ' END'
+            )
+            conn.execute(
+                'CREATE TRIGGER customers_au AFTER UPDATE OF customer_name, customer_phone, status, appointment_date ON appointments BEGIN '
+                + customer_sync_sql(CUSTOMER_REMOVE_SQL, 'OLD') + customer_sync_sql(CUSTOMER_ADD_SQL, 'NEW')
+                + customer_sync_sql(CUSTOMER_REFRESH_SQL, 'OLD') + customer_sync_sql(CUSTOMER_REFRESH_SQL, 'NEW')
+                + ' END'
+            )
+        
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        conn.execute('ROLLBACK')
+        raise
+    conn.isolation_level = ''
+    
     # Insertar datos iniciales si no existen
     
     # Usuario admin por defecto
@@ -168,6 +355,63 @@ def require_auth(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def request_fingerprint(data):
+    """Huella del cuerpo de la petición para detectar claves reutilizadas con otros datos"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def get_idempotent_response(conn, key, fingerprint):
+    """Devolver la respuesta guardada para una clave de idempotencia vigente, si existe"""
+    stored = conn.execute(
+        "SELECT request_hash, status_code, response_body FROM idempotency_keys WHERE key = ? AND expires_at > datetime('now')",
+        (key,)
+    ).fetchone()
+    if not stored:
+        return None
+    if stored['request_hash'] != fingerprint:
+        return jsonify({'error': 'Idempotency-Key already used with a different request'}), 422
+    return jsonify(json.loads(stored['response_body'])), stored['status_code']
+
+def purge_expired_idempotency_keys():
+    """Eliminar las claves de idempotencia expiradas"""
+    conn = get_db_connection()
+    cursor = conn.execute("DELETE FROM idempotency_keys WHERE expires_at <= datetime('now')")
+    conn.commit()
+    conn.close()
+    return cursor.rowcount
+
+def start_idempotency_purger():
+    """Purgar periódicamente las claves expiradas en un hilo en segundo plano"""
+    def purge_loop():
+        while True:
+            try:
+                purge_expired_idempotency_keys()
+            except sqlite3.Error as e:
+                print(f"Error purgando claves de idempotencia: {e}")
+            time.sleep(IDEMPOTENCY_PURGE_INTERVAL_SECONDS)
+    
+    thread = threading.Thread(target=purge_loop, name='idempotency-purger', daemon=True)
+    thread.start()
+    return thread
+
+def build_search_query(text):
+    """Convertir el texto del usuario en una consulta FTS5 de prefijos (None si no hay términos)"""
+    # Un teléfono con separadores se busca como un solo número
+    if re.fullmatch(r'[\d\s\-\(\)\+\.]+', text) and re.search(r'\d', text):
+        terms = [re.sub(r'\D', '', text)]
+    else:
+        terms = re.findall(r'\w+', text)
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def customer_summary(customer):
+    """Datos del cliente con la tasa de no-show calculada"""
+    summary = dict(customer)
+    attended_or_missed = customer['completed_count'] + customer['no_show_count']
+    summary['visit_count'] = customer['completed_count']
+    summary['no_show_rate'] = round(customer['no_show_count'] / attended_or_missed, 4) if attended_or_missed else 0.0
+    return summary
+
 # ==================== RUTAS DE AUTENTICACIÓN ====================
 
 @app.route('/api/login', methods=['POST'])
@@ -280,6 +524,7 @@ def get_appointments():
     """Obtener citas - acceso público con filtros para cliente"""
     date_filter = request.args.get('date')
     status_filter = request.args.get('status')
+    search_filter = request.args.get('search')
     
     query = '''
         SELECT a.*, s.name as service_name, s.price as service_price 
@@ -297,6 +542,12 @@ def get_appointments():
         conditions.append('a.status = ?')
         params.append(status_filter)
     
+    # La búsqueda por nombre, teléfono o notas solo está disponible para el admin
+    search_query = build_search_query(search_filter) if search_filter and 'user_id' in session else None
+    if search_query:
+        conditions.append('a.id IN (SELECT rowid FROM appointments_fts WHERE appointments_fts MATCH ?)')
+        params.append(search_query)
+    
     if conditions:
         query += ' WHERE ' + ' AND '.join(conditions)
     
@@ -321,38 +572,80 @@ def get_appointments():
 
 @app.route('/api/appointments', methods=['POST'])
 def create_appointment():
-    """Crear una nueva cita"""
+    """Crear una nueva cita (admite el encabezado Idempotency-Key para reintentos seguros)"""
     data = request.get_json()
     
     required_fields = ['service_id', 'customer_name', 'customer_phone', 'appointment_date', 'appointment_time']
-    if not all(field in data for field in required_fields):
+    if not isinstance(data, dict) or not all(field in data for field in required_fields):
         return jsonify({'error': 'Missing required fields'}), 400
     
-    # Verificar que el horario esté disponible
-    conn = get_db_connection()
-    existing = conn.execute(
-        'SELECT id FROM appointments WHERE appointment_date = ? AND appointment_time = ? AND status != "cancelled"',
-        (data['appointment_date'], data['appointment_time'])
-    ).fetchone()
+    # Solo valores simples antes de tomar el bloqueo: un objeto o null no debe llegar a SQLite
+    scalar_types = (str, int, float)
+    if not all(isinstance(data[field], scalar_types) for field in required_fields):
+        return jsonify({'error': 'Invalid field values'}), 400
+    if not all(data.get(field) is None or isinstance(data[field], scalar_types) for field in ['deposit_amount', 'notes']):
+        return jsonify({'error': 'Invalid field values'}), 400
     
-    if existing:
-        conn.close()
-        return jsonify({'error': 'Time slot not available'}), 409
+    idempotency_key = request.headers.get('Idempotency-Key')
+    fingerprint = request_fingerprint(data)
     
-    # Crear la cita
-    cursor = conn.execute(
-        '''INSERT INTO appointments 
-           (service_id, customer_name, customer_phone, appointment_date, appointment_time, deposit_amount, notes) 
-           VALUES (?, ?, ?, ?, ?, ?, ?)''',
-        (data['service_id'], data['customer_name'], data['customer_phone'], 
-         data['appointment_date'], data['appointment_time'], 
-         data.get('deposit_amount', 50.00), data.get('notes', ''))
-    )
-    appointment_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    conn = get_db_connection()
+    try:
+        # Un reintento con la misma clave devuelve la respuesta original sin tomar el bloqueo de escritura
+        if idempotency_key:
+            replay = get_idempotent_response(conn, idempotency_key, fingerprint)
+            if replay:
+                return replay
+        
+        # Tomar el bloqueo de escritura antes de verificar para que la verificación y la inserción sean atómicas
+        conn.isolation_level = None
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Otra petición con la misma clave pudo terminar mientras esperábamos el bloqueo
+            if idempotency_key:
+                replay = get_idempotent_response(conn, idempotency_key, fingerprint)
+                if replay:
+                    conn.execute('ROLLBACK')
+                    return replay
+            
+            # Verificar que el horario esté disponible
+            existing = conn.execute(
+                'SELECT id FROM appointments WHERE appointment_date = ? AND appointment_time = ? AND status != "cancelled"',
+                (data['appointment_date'], data['appointment_time'])
+            ).fetchone()
+            
+            if existing:
+                conn.execute('ROLLBACK')
+                return jsonify({'error': 'Time slot not available'}), 409
+            
+            # Crear la cita
+            cursor = conn.execute(
+                '''INSERT INTO appointments 
+                   (service_id, customer_name, customer_phone, appointment_date, appointment_time, deposit_amount, notes) 
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (data['service_id'], data['customer_name'], data['customer_phone'], 
+                 data['appointment_date'], data['appointment_time'], 
+                 data.get('deposit_amount', 50.00), data.get('notes', ''))
+            )
+            appointment_id = cursor.lastrowid
+            response_body = {'id': appointment_id, 'message': 'Appointment created successfully'}
+            
+            # Guardar la respuesta en la misma transacción que la cita
+            if idempotency_key:
+                conn.execute(
+                    '''INSERT OR REPLACE INTO idempotency_keys (key, request_hash, status_code, response_body, expires_at)
+                       VALUES (?, ?, ?, ?, datetime('now', ?))''',
+                    (idempotency_key, fingerprint, 201, json.dumps(response_body), f'+{IDEMPOTENCY_KEY_TTL_HOURS} hours')
+                )
+            
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
     
-    return jsonify({'id': appointment_id, 'message': 'Appointment created successfully'}), 201
+    return jsonify(response_body), 201
 
 @app.route('/api/appointments/<int:appointment_id>', methods=['PUT'])
 @require_auth
@@ -403,6 +696,75 @@ def delete_appointment(appointment_id):
     
     return jsonify({'message': 'Appointment deleted successfully'}), 200
 
+# ==================== RUTAS DE CLIENTES ====================
+
+@app.route('/api/customers/search', methods=['GET'])
+@require_auth
+def search_customers():
+    """Buscar clientes por prefijo de nombre, teléfono o notas, ordenados por relevancia"""
+    search_query = build_search_query(request.args.get('q', ''))
+    if not search_query:
+        return jsonify({'error': 'Search query required'}), 400
+    
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    
+    conn = get_db_connection()
+    
+    # Con pocas coincidencias se ordenan todas por relevancia; con prefijos muy amplios
+    # solo se puntúan las citas más recientes para no calcular bm25 sobre todo el índice
+    match_count = conn.execute(
+        'SELECT COUNT(*) FROM appointments_fts WHERE appointments_fts MATCH ?', (search_query,)
+    ).fetchone()[0]
+    match_order = 'score' if match_count <= CUSTOMER_SEARCH_MAX_MATCHES else 'rowid DESC'
+    
+    customers = conn.execute(
+        '''WITH matches AS (
+               SELECT rowid, bm25(appointments_fts, 10.0, 5.0, 1.0) AS score
+               FROM appointments_fts
+               WHERE appointments_fts MATCH ?
+               ORDER BY ''' + match_order + '''
+               LIMIT ?
+           )
+           SELECT c.*, MIN(m.score) AS score
+           FROM matches m
+           JOIN appointments a ON a.id = m.rowid
+           JOIN customers c ON c.customer_phone = ''' + PHONE_DIGITS_SQL.format('a.customer_phone') + '''
+           GROUP BY c.customer_phone
+           ORDER BY score, c.last_visit DESC
+           LIMIT ?''',
+        (search_query, CUSTOMER_SEARCH_MAX_MATCHES, limit)
+    ).fetchall()
+    conn.close()
+    
+    return jsonify([customer_summary(customer) for customer in customers])
+
+@app.route('/api/customers/<customer_phone>', methods=['GET'])
+@require_auth
+def get_customer(customer_phone):
+    """Obtener estadísticas e historial de citas de un cliente"""
+    customer_phone = normalize_phone(customer_phone)
+    
+    conn = get_db_connection()
+    customer = conn.execute('SELECT * FROM customers WHERE customer_phone = ?', (customer_phone,)).fetchone()
+    if not customer:
+        conn.close()
+        return jsonify({'error': 'Customer not found'}), 404
+    
+    appointments = conn.execute(
+        '''SELECT a.*, s.name as service_name, s.price as service_price 
+           FROM appointments a 
+           LEFT JOIN services s ON a.service_id = s.id
+           WHERE ''' + PHONE_DIGITS_SQL.format('a.customer_phone') + ''' = ?
+           ORDER BY a.appointment_date DESC, a.appointment_time DESC''',
+        (customer_phone,)
+    ).fetchall()
+    conn.close()
+    
+    return jsonify({
+        'customer': customer_summary(customer),
+        'appointments': [dict(appointment) for appointment in appointments]
+    })
+
 # ==================== RUTAS DE HORARIOS DISPONIBLES ====================
 
 @app.route('/api/available-times', methods=['GET'])
@@ -633,6 +995,19 @@ def internal_error(error):
 
 # ==================== INICIALIZACIÓN ====================
 
+idempotency_purger = None
+idempotency_purger_lock = threading.Lock()
+
+@app.before_request
+def ensure_idempotency_purger():
+    """Arrancar el purgador con la primera petición del proceso que la atiende"""
+    # Para entonces init_db ya se ejecutó, y el proceso padre del recargador nunca atiende peticiones
+    global idempotency_purger
+    if idempotency_purger is None:
+        with idempotency_purger_lock:
+            if idempotency_purger is None:
+                idempotency_purger = start_idempotency_purger()
+
 if __name__ == '__main__':
     init_db()
     print("Servidor iniciado en http://localhost:5000")